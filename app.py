@@ -1,13 +1,32 @@
-from flask import Flask, request, jsonify, send_file, redirect, url_for
+from flask import Flask, Response, request, jsonify, send_file, redirect, url_for
 import requests
+from requests.adapters import HTTPAdapter
 from shapely.geometry import shape
 from shapely.ops import transform
 import pyproj
+import numpy as np
 import re
 import os
+import orjson
+import time
+import hashlib
+import io
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import simplekml
 import tempfile
 
+# Character-class bodies for the parsing patterns. RE2's \w, \d and \s are
+# ASCII-only, so under RE2 they are spelled out to match what stdlib re's
+# Unicode classes accept (e.g. "123 CAÑADA DR").
+try:
+    import re2 as regex  # google-re2: linear-time matching, no backtracking
+    _WORD, _DIGIT, _SPACE = r'\pL\pN_', r'\p{Nd}', r'\t\n\v\f\r\x1c-\x1f\x85\pZ'
+except ImportError:
+    regex = re
+    _WORD, _DIGIT, _SPACE = r'\w', r'\d', r'\s'
+
 app = Flask(__name__)
 
 COUNTY_CONFIG = {
@@ -43,11 +62,95 @@ COUNTY_CONFIG = {
     }
 }
 
+CountyFields = namedtuple("CountyFields", [
+    "street_num", "street_name", "street_type", "owner", "legal", "deed",
+    "parcel_id", "quickrefid", "acres", "market"
+])
+
+# Per-county query pieces that only depend on COUNTY_CONFIG. The address
+# clause templates are tiers ordered most specific first (number + name + type,
+# number + name, name), each a (prefix match, substring match) pair.
+CountyQuery = namedtuple("CountyQuery", [
+    "endpoint", "fields", "out_fields", "quickref_clause", "parcel_clause", "address_clauses"
+])
+
+def _build_county_query(config):
+    f = CountyFields(**config["fields"])
+    num = f"{f.street_num} = '{{num}}'"
+    return CountyQuery(
+        endpoint=config["endpoint"],
+        fields=f,
+        out_fields=",".join(f),
+        quickref_clause=f"{f.quickrefid} = '{{quickref}}'",
+        # The KMZ key is the parcel ID, or the quick ref when a parcel has none.
+        parcel_clause=f"{f.parcel_id} = '{{parcel_id}}' OR {f.quickrefid} = '{{parcel_id}}'",
+        address_clauses=(
+            (f"{num} AND {f.street_name} LIKE '{{name}}%' AND {f.street_type} = '{{st}}'",
+             f"{num} AND UPPER({f.street_name}) LIKE '%{{name}}%' AND UPPER({f.street_type}) = '{{st}}'"),
+            (f"{num} AND {f.street_name} LIKE '{{name}}%'",
+             f"{num} AND UPPER({f.street_name}) LIKE '%{{name}}%'"),
+            (f"{f.street_name} LIKE '{{name}}%'",
+             f"UPPER({f.street_name}) LIKE '%{{name}}%'"),
+        ),
+    )
+
+COUNTY_QUERIES = {county: _build_county_query(config) for county, config in COUNTY_CONFIG.items()}
+
 CRS_TARGET = "EPSG:2278"
 
+_TRANSFORMER = pyproj.Transformer.from_crs("EPSG:4326", CRS_TARGET, always_xy=True)
+# Rings below this vertex count are streamed through itransform; larger
+# rings are copied into NumPy arrays and transformed in place.
+_INPLACE_MIN_VERTICES = 200
+# A lone ring above this size is split into vertex ranges projected in parallel.
+_SPLIT_MIN_VERTICES = 10000
+
+_ADDRESS_RE = regex.compile(rf'(?i)^([{_DIGIT}]+)?[{_SPACE}]*([{_WORD}{_SPACE}]+?)([{_SPACE}]+(RD|ST|DR|LN|BLVD|CT|AVE|HWY|WAY|TRAIL|PKWY|CIR))?$')
+# One pass over a legal description. Every alternative starts at a keyword,
+# so the first match marks where the subdivision name ends.
+_LEGAL_RE = regex.compile(rf'(?i)BLOCK[{_SPACE}]+(?P<block>[{_WORD}]+)|(?P<lot>(?:LOT|RESERVE)[{_SPACE}]+["{_WORD}]+)|BLOCK|LOT|RESERVE|ACRES')
+
+# Reprojection is CPU work (PROJ releases the GIL), kept off the I/O pool so
+# it never queues behind ArcGIS round trips. Sized from the CPUs this process
+# may run on (os.cpu_count() reports the host's inside containers), capped so
+# a huge ring isn't split into slivers.
+if hasattr(os, "sched_getaffinity"):
+    _CPU_WORKERS = min(len(os.sched_getaffinity(0)), 8)
+else:
+    _CPU_WORKERS = min(os.cpu_count() or 4, 8)
+_CPU_EXECUTOR = ThreadPoolExecutor(max_workers=_CPU_WORKERS)
+
+# ArcGIS calls block for a network round trip, so every request thread gets
+# room for all of its candidate clauses at once. WEB_THREADS is shared with
+# gunicorn's --threads in Procfile.txt.
+_REQUEST_THREADS = int(os.environ.get("WEB_THREADS", 16))
+_MAX_CLAUSES_PER_ROUND = 4
+_IO_EXECUTOR = ThreadPoolExecutor(max_workers=_REQUEST_THREADS * _MAX_CLAUSES_PER_ROUND)
+
+# One connection per pooled query plus one for each request thread's direct
+# calls (quick ref lookups, KMZ downloads).
+_SESSION = requests.Session()
+_SESSION.headers["Accept-Encoding"] = "gzip"
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10, pool_maxsize=_REQUEST_THREADS * (_MAX_CLAUSES_PER_ROUND + 1)))
+
+# Raw ArcGIS responses keyed by (endpoint, query params). Entries older than
+# the TTL are kept so they can be revalidated with their ETag.
+_QUERY_CACHE_TTL = 3600
+_QUERY_CACHE_SIZE = 1024
+_query_cache = OrderedDict()
+_query_cache_lock = threading.Lock()
+
+# Generated KMZ files, one per (county, parcel). Served with the same max-age
+# that bounds how long a cached file is reused.
+KMZ_CACHE_DIR = os.path.join("/tmp", "kmz_cache")
+KMZ_CACHE_MAX_AGE = 3600
+
+# Response keys that need the parcel reprojected into CRS_TARGET.
+MEASURE_FIELDS = {"parcel_size_acres", "perimeter_ft"}
+
 def parse_address_loose(address):
-    pattern = re.compile(r'^(\d+)?\s*([\w\s]+?)(\s+(RD|ST|DR|LN|BLVD|CT|AVE|HWY|WAY|TRAIL|PKWY|CIR))?$', re.IGNORECASE)
-    match = pattern.search(address.strip().upper())
+    match = _ADDRESS_RE.search(address.strip().upper())
     if match:
         number = match.group(1) or ''
         name = match.group(2).strip()
@@ -57,28 +160,177 @@ def parse_address_loose(address):
 
 def parse_legal_description(legal):
     subdivision = block = lot = None
-    subdivision_match = re.match(r'^(.*?)(BLOCK|LOT|RESERVE|ACRES)', legal, re.IGNORECASE)
-    if subdivision_match:
-        subdivision = subdivision_match.group(1).strip(", ").title()
-    block_match = re.search(r'BLOCK\s+(\w+)', legal, re.IGNORECASE)
-    if block_match:
-        block = block_match.group(1)
-    lot_match = re.search(r'(LOT|RESERVE)\s+["\w]+', legal, re.IGNORECASE)
-    if lot_match:
-        lot = lot_match.group(0).strip()
+    for match in _LEGAL_RE.finditer(legal):
+        if subdivision is None:
+            subdivision = legal[:match.start()].strip(", ").title()
+        if block is None and match.group("block") is not None:
+            block = match.group("block")
+        elif lot is None and match.group("lot") is not None:
+            lot = match.group("lot").strip()
+        if block is not None and lot is not None:
+            break
     return subdivision, block, lot
 
-def query_parcels(endpoint, where_clause):
+def _escape_sql(value):
+    # Quote-escape for the ArcGIS where clause and drop LIKE wildcards so user
+    # input can't widen the server-side search.
+    return value.replace("'", "''").replace("%", "").replace("_", "")
+
+def _address_clauses(templates, number, name, st_type):
+    if number and st_type:
+        chosen = templates
+    elif number:
+        chosen = templates[1:]
+    else:
+        chosen = templates[2:]
+    return [tuple(t.format(num=number, name=name, st=st_type) for t in tier) for tier in chosen]
+
+def query_parcels(endpoint, where_clause, out_fields):
+    # estimate only reads the mapped fields of the first match.
     params = {
         "where": where_clause,
-        "outFields": "*",
+        "outFields": out_fields,
+        "resultRecordCount": "1",
         "returnGeometry": "true",
         "outSR": "4326",
         "f": "geojson"
     }
-    r = requests.get(endpoint, params=params, timeout=10)
-    r.raise_for_status()
-    return r.json().get("features", [])
+    return _cached_fetch(endpoint, params).get("features", [])
+
+def query_first_match(endpoint, clauses, out_fields):
+    # Clauses are ordered most-specific first; run them all at once and
+    # keep the first one (in that order) that returns parcels.
+    futures = [_IO_EXECUTOR.submit(query_parcels, endpoint, c, out_fields) for c in clauses]
+    matches = []
+    for i, future in enumerate(futures):
+        matches = future.result()
+        if matches:
+            for pending in futures[i + 1:]:
+                pending.cancel()
+            break
+    return matches
+
+def _cached_fetch(endpoint, params):
+    key = (endpoint, tuple(sorted(params.items())))
+    with _query_cache_lock:
+        entry = _query_cache.get(key)
+        if entry:
+            _query_cache.move_to_end(key)
+    headers = {}
+    if entry:
+        fetched_at, etag, body = entry
+        if time.monotonic() - fetched_at < _QUERY_CACHE_TTL:
+            return orjson.loads(body)
+        if etag:
+            headers["If-None-Match"] = etag
+    r = _SESSION.get(endpoint, params=params, headers=headers, timeout=10)
+    if entry and r.status_code == 304:
+        etag, body = entry[1], entry[2]
+    else:
+        r.raise_for_status()
+        etag, body = r.headers.get("ETag"), r.content
+    data = orjson.loads(body)
+    # ArcGIS reports query failures as HTTP 200 with an "error" body; don't
+    # let a transient failure stick around as an empty result.
+    if "error" in data:
+        return data
+    with _query_cache_lock:
+        _query_cache[key] = (time.monotonic(), etag, body)
+        _query_cache.move_to_end(key)
+        while len(_query_cache) > _QUERY_CACHE_SIZE:
+            _query_cache.popitem(last=False)
+    return data
+
+def _project_ring(coords, transformer, chunks=1):
+    if len(coords) < _INPLACE_MIN_VERTICES:
+        return list(transformer.itransform(coords))
+    xy = np.asarray(coords, dtype=np.float64)
+    x = np.ascontiguousarray(xy[:, 0])
+    y = np.ascontiguousarray(xy[:, 1])
+    if chunks > 1:
+        bounds = np.linspace(0, len(x), chunks + 1).astype(int)
+        jobs = [_CPU_EXECUTOR.submit(transformer.transform, x[a:b], y[a:b], inplace=True)
+                for a, b in zip(bounds[:-1], bounds[1:])]
+        for job in jobs:
+            job.result()
+    else:
+        transformer.transform(x, y, inplace=True)
+    return np.column_stack([x, y])
+
+def _project_rings(rings, transformer):
+    # Rings big enough for the in-place path go to the CPU pool when there are
+    # several of them; short rings are cheaper through itransform inline than
+    # a pool hop. A lone very large ring is split into parallel vertex ranges.
+    big = {i for i, ring in enumerate(rings) if len(ring) >= _INPLACE_MIN_VERTICES}
+    if len(big) > 1:
+        jobs = {i: _CPU_EXECUTOR.submit(_project_ring, rings[i], transformer) for i in big}
+        return [jobs[i].result() if i in jobs else _project_ring(ring, transformer)
+                for i, ring in enumerate(rings)]
+    return [_project_ring(ring, transformer, _CPU_WORKERS if len(ring) > _SPLIT_MIN_VERTICES else 1)
+            for ring in rings]
+
+def _ring_measures(ring):
+    xy = np.asarray(ring, dtype=np.float64)
+    # Shift to the first vertex so the shoelace sums don't lose precision
+    # on state-plane magnitudes.
+    x = xy[:, 0] - xy[0, 0]
+    y = xy[:, 1] - xy[0, 1]
+    length = np.sum(np.hypot(np.diff(x), np.diff(y)))
+    area = 0.5 * abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+    return float(length), float(area)
+
+def projected_measures(geom, transformer):
+    # Perimeter and area in the target CRS, taken straight from the projected
+    # ring coordinates (shoelace formula) without building a projected geometry.
+    if geom.geom_type == "Polygon":
+        polygons = [geom]
+    elif geom.geom_type == "MultiPolygon":
+        polygons = geom.geoms
+    else:
+        polygons = None
+    if polygons and not geom.is_empty:
+        rings, signs = [], []
+        for poly in polygons:
+            rings.append(poly.exterior.coords)
+            signs.append(1)
+            for interior in poly.interiors:
+                rings.append(interior.coords)
+                signs.append(-1)
+        try:
+            perimeter = area = 0.0
+            for ring, sign in zip(_project_rings(rings, transformer), signs):
+                length, ring_area = _ring_measures(ring)
+                perimeter += length
+                area += sign * ring_area
+            return perimeter, area
+        except TypeError:
+            pass
+    geom_proj = transform(transformer.transform, geom)
+    return geom_proj.length, geom_proj.area
+
+def feature_geometry(feature):
+    # shapely.from_geojson (after re-serializing the dict) only wins below ~20
+    # vertices, by a few microseconds; from there up shape() is 1.1-1.5x faster.
+    # It also needs GEOS >= 3.10, so shape() stays.
+    return shape(feature["geometry"])
+
+def kmz_cache_path(county, parcel_id):
+    key = hashlib.sha1(f"{county}:{parcel_id}".encode()).hexdigest()
+    return os.path.join(KMZ_CACHE_DIR, f"{key}.kmz")
+
+def _kmz_is_fresh(path):
+    try:
+        return time.time() - os.path.getmtime(path) < KMZ_CACHE_MAX_AGE
+    except OSError:
+        return False
+
+def _write_kmz(path, kmz_bytes):
+    # Write beside the target and rename so concurrent requests never serve
+    # a half-written file.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".kmz", dir=os.path.dirname(path)) as tmp:
+        tmp.write(kmz_bytes)
+    os.replace(tmp.name, path)
 
 def generate_kmz(geom, metadata=None):
     kml = simplekml.Kml()
@@ -97,15 +349,43 @@ def generate_kmz(geom, metadata=None):
         if metadata:
             html = ''.join([f"<b>{k}:</b> {v}<br>" for k, v in metadata.items()])
             poly.description = html
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".kmz")
-    kml.savekmz(tmp.name)
-    return tmp.name
+    buf = io.BytesIO()
+    kml.savekmz(buf)
+    return buf.getvalue()
+
+def parcel_kmz(feature, fields, geom, perimeter_ft, area_acres):
+    props = feature["properties"]
+    legal = props.get(fields.legal, "N/A")
+    subdivision, block, lot = parse_legal_description(legal)
+    metadata = {
+        "Owner": props.get(fields.owner, "N/A"),
+        "Geo ID": props.get(fields.parcel_id, ""),
+        "Legal": legal,
+        "Subdivision": subdivision or "",
+        "Block": block or "",
+        "Lot/Reserve": lot or "",
+        "Deed": props.get(fields.deed, "") or "",
+        "Area (ac)": f"{area_acres:.2f}",
+        "Perimeter (ft)": f"{perimeter_ft:.2f}"
+    }
+    return generate_kmz(geom, metadata)
+
+def _send_kmz(source, parcel_id):
+    response = send_file(source, mimetype="application/vnd.google-earth.kmz", as_attachment=True,
+                         download_name=f"parcel_{parcel_id}.kmz", max_age=KMZ_CACHE_MAX_AGE)
+    response.cache_control.public = True
+    return response
 
 @app.route("/estimate", methods=["GET"])
 def estimate():
     address = request.args.get("address")
     county = request.args.get("county", "fortbend").lower()
     quickref = request.args.get("quickref")
+    # KMZ files are built on demand by /download_kmz unless ?kmz=1 asks for it
+    # up front; ?fields= limits the response (and the work) to named keys.
+    build_kmz = request.args.get("kmz", "").lower() in ("1", "true")
+    wanted = request.args.get("fields")
+    wanted = {name.strip() for name in wanted.split(",")} if wanted else None
 
     if not (address or quickref):
         return jsonify({"error": "Missing address or quickref"}), 400
@@ -113,89 +393,76 @@ def estimate():
     if county not in COUNTY_CONFIG:
         return jsonify({"error": f"Unsupported county: {county}"}), 400
 
-    config = COUNTY_CONFIG[county]
-    endpoint = config["endpoint"]
-    fields = config["fields"]
+    county_query = COUNTY_QUERIES[county]
+    endpoint = county_query.endpoint
+    out_fields = county_query.out_fields
+    fields = county_query.fields
 
     matches = []
     if quickref:
-        where_clause = f"{fields['quickrefid']} = '{quickref}'"
-        matches = query_parcels(endpoint, where_clause)
+        where_clause = county_query.quickref_clause.format(quickref=_escape_sql(quickref))
+        matches = query_parcels(endpoint, where_clause, out_fields)
     elif address:
         number, name, st_type = parse_address_loose(address)
+        if name:
+            number, name, st_type = _escape_sql(number), _escape_sql(name), _escape_sql(st_type)
         if not name:
             return jsonify({"error": "Invalid address format"}), 400
-        clauses = []
-        if number and st_type:
-            clauses.append(f"{fields['street_num']} = '{number}' AND UPPER({fields['street_name']}) LIKE '%{name.upper()}%' AND UPPER({fields['street_type']}) = '{st_type.upper()}'")
-        if number:
-            clauses.append(f"{fields['street_num']} = '{number}' AND UPPER({fields['street_name']}) LIKE '%{name.upper()}%'")
-        clauses.append(f"UPPER({fields['street_name']}) LIKE '%{name.upper()}%'")
-        for clause in clauses:
-            matches = query_parcels(endpoint, clause)
-            if matches:
-                break
+        # County street fields are stored uppercase, so a bare prefix LIKE can
+        # use the column index. A more specific tier always wins over a less
+        # specific one; within a tier the prefix match is preferred. The
+        # number-qualified tiers are narrowed by the street number either way,
+        # so they run together; the name-only substring scan runs last.
+        *numbered, (name_prefix, name_contains) = _address_clauses(
+            county_query.address_clauses, number, name, st_type)
+        matches = query_first_match(endpoint, [c for tier in numbered for c in tier], out_fields)
+        if not matches:
+            matches = query_parcels(endpoint, name_prefix, out_fields)
+        if not matches:
+            matches = query_parcels(endpoint, name_contains, out_fields)
 
     if not matches:
         return jsonify({"error": "No parcels found. Please check the address spelling or try providing a Quick Ref ID."}), 404
 
     feature = matches[0]
     props = feature["properties"]
-    legal = props.get(fields["legal"], "N/A")
-    deed = props.get(fields["deed"], "")
-    owner = props.get(fields["owner"], "N/A")
-    acres = props.get(fields["acres"], "N/A")
-    market_val = props.get(fields["market"], "N/A")
-    quickrefid = props.get(fields["quickrefid"], "")
-    parcel_id = props.get(fields["parcel_id"], "")
-    address_full = f"{props.get(fields['street_num'], '')} {props.get(fields['street_name'], '')} {props.get(fields['street_type'], '')}".strip()
+    legal = props.get(fields.legal, "N/A")
+    deed = props.get(fields.deed, "")
+    owner = props.get(fields.owner, "N/A")
+    acres = props.get(fields.acres, "N/A")
+    market_val = props.get(fields.market, "N/A")
+    quickrefid = props.get(fields.quickrefid, "")
+    parcel_id = props.get(fields.parcel_id, "")
+    address_full = f"{props.get(fields.street_num, '')} {props.get(fields.street_name, '')} {props.get(fields.street_type, '')}".strip()
 
     subdivision, block, lot = parse_legal_description(legal)
 
-    geom = shape(feature["geometry"])
-    project = pyproj.Transformer.from_crs("EPSG:4326", CRS_TARGET, always_xy=True).transform
-    geom_proj = transform(project, geom)
-    perimeter_ft = geom_proj.length
-    area_ft2 = geom_proj.area
-    area_acres = area_ft2 / 43560
+    needs_measures = build_kmz or wanted is None or not wanted.isdisjoint(MEASURE_FIELDS)
+    geom = None
+    if needs_measures or "maps_link" in wanted:
+        geom = feature_geometry(feature)
+    area_acres = perimeter_ft = None
+    if needs_measures:
+        perimeter_ft, area_ft2 = projected_measures(geom, _TRANSFORMER)
+        area_acres = area_ft2 / 43560
 
-    centroid = geom.centroid
-    maps_url = f"https://www.google.com/maps/search/?api=1&query={centroid.y},{centroid.x}"
+    maps_url = None
+    if geom is not None:
+        centroid = geom.centroid
+        maps_url = f"https://www.google.com/maps/search/?api=1&query={centroid.y},{centroid.x}"
 
-    kmz_metadata = {
-        "Owner": owner,
-        "Geo ID": parcel_id,
-        "Legal": legal,
-        "Subdivision": subdivision or "",
-        "Block": block or "",
-        "Lot/Reserve": lot or "",
-        "Deed": deed or "",
-        "Area (ac)": f"{area_acres:.2f}",
-        "Perimeter (ft)": f"{perimeter_ft:.2f}"
-    }
+    # KMZ files are cached and looked up again by parcel ID, so a parcel
+    # without one gets no download link.
+    kmz_key = parcel_id or quickrefid
+    download_kmz_url = None
+    if kmz_key:
+        if build_kmz:
+            kmz_path = kmz_cache_path(county, kmz_key)
+            if not _kmz_is_fresh(kmz_path):
+                _write_kmz(kmz_path, parcel_kmz(feature, fields, geom, perimeter_ft, area_acres))
+        download_kmz_url = url_for("download_kmz", county=county, parcel_id=kmz_key, _external=True)
 
-    kmz_filename = f"parcel_{quickrefid or parcel_id or 'default'}.kmz"
-    kmz_path = os.path.join("/tmp", kmz_filename)
-    kml = simplekml.Kml()
-    poly = None
-    if geom.geom_type == "Polygon":
-        coords = [(x, y) for x, y in list(geom.exterior.coords)]
-        poly = kml.newpolygon(name="Parcel", outerboundaryis=coords)
-    elif geom.geom_type == "MultiPolygon":
-        for poly_geom in geom.geoms:
-            coords = [(x, y) for x, y in list(poly_geom.exterior.coords)]
-            poly = kml.newpolygon(name="Parcel Part", outerboundaryis=coords)
-    if poly:
-        poly.style.polystyle.fill = 0
-        poly.style.linestyle.color = simplekml.Color.red
-        poly.style.linestyle.width = 5
-        html = ''.join([f"<b>{k}:</b> {v}<br>" for k, v in kmz_metadata.items()])
-        poly.description = html
-    kml.savekmz(kmz_path)
-
-    download_kmz_url = url_for("download_kmz", filename=kmz_filename, _external=True)
-
-    return jsonify({
+    result = {
         "owner": owner,
         "address": address_full,
         "legal_description": legal,
@@ -207,91 +474,121 @@ def estimate():
         "market_value": market_val,
         "quickrefid": quickrefid,
         "parcel_id": parcel_id,
-        "parcel_size_acres": round(area_acres, 2),
-        "perimeter_ft": round(perimeter_ft, 2),
+        "parcel_size_acres": round(area_acres, 2) if needs_measures else None,
+        "perimeter_ft": round(perimeter_ft, 2) if needs_measures else None,
         "maps_link": maps_url,
         "kmz_download_url": download_kmz_url
-    })
+    }
+    if wanted is not None:
+        result = {k: v for k, v in result.items() if k in wanted}
+    return jsonify(result)
 
 @app.route("/download_kmz")
 def download_kmz():
-    filename = request.args.get("filename")
-    if not filename:
-        return "Missing filename.", 400
+    county = request.args.get("county", "fortbend").lower()
+    parcel_id = request.args.get("parcel_id")
+    if not parcel_id:
+        return "Missing parcel_id.", 400
+
+    kmz_path = kmz_cache_path(county, parcel_id)
+    if _kmz_is_fresh(kmz_path):
+        return _send_kmz(kmz_path, parcel_id)
 
-    kmz_path = os.path.join("/tmp", filename)
-    if not os.path.exists(kmz_path):
+    if county not in COUNTY_QUERIES:
+        return f"Unsupported county: {county}", 400
+    county_query = COUNTY_QUERIES[county]
+    where_clause = county_query.parcel_clause.format(parcel_id=_escape_sql(parcel_id))
+    matches = query_parcels(county_query.endpoint, where_clause, county_query.out_fields)
+    if not matches:
         return "KMZ not found.", 404
 
-    return send_file(kmz_path, as_attachment=True, download_name=filename)
+    feature = matches[0]
+    geom = feature_geometry(feature)
+    perimeter_ft, area_ft2 = projected_measures(geom, _TRANSFORMER)
+    kmz_bytes = parcel_kmz(feature, county_query.fields, geom, perimeter_ft, area_ft2 / 43560)
+    # Serve the file just written so the first download carries the same
+    # send_file ETag as later cache hits.
+    _write_kmz(kmz_path, kmz_bytes)
+    return _send_kmz(kmz_path, parcel_id)
 
-@app.route("/openapi.json")
-def openapi_spec():
-    return jsonify({
-        "openapi": "3.1.0",
-        "info": {
-            "title": "Tejas Estimator API",
-            "version": "1.0.0",
-            "description": "Retrieve parcel estimate details based on address or Quick Ref ID in Fort Bend or Harris County."
-        },
-        "servers": [
-            { "url": "https://tejas-estimator-api.onrender.com" }
-        ],
-        "paths": {
-            "/estimate": {
-                "get": {
-                    "operationId": "get_survey_estimate",
-                    "summary": "Get survey estimate",
-                    "parameters": [
-                        {
-                            "name": "address",
-                            "in": "query",
-                            "required": False,
-                            "schema": { "type": "string" },
-                            "description": "The property address to estimate."
-                        },
-                        {
-                            "name": "quickref",
-                            "in": "query",
-                            "required": False,
-                            "schema": { "type": "string" },
-                            "description": "The Quick Ref ID to search."
+OPENAPI_SPEC = {
+    "openapi": "3.1.0",
+    "info": {
+        "title": "Tejas Estimator API",
+        "version": "1.0.0",
+        "description": "Retrieve parcel estimate details based on address or Quick Ref ID in Fort Bend or Harris County."
+    },
+    "servers": [
+        { "url": "https://tejas-estimator-api.onrender.com" }
+    ],
+    "paths": {
+        "/estimate": {
+            "get": {
+                "operationId": "get_survey_estimate",
+                "summary": "Get survey estimate",
+                "parameters": [
+                    {
+                        "name": "address",
+                        "in": "query",
+                        "required": False,
+                        "schema": { "type": "string" },
+                        "description": "The property address to estimate."
+                    },
+                    {
+                        "name": "quickref",
+                        "in": "query",
+                        "required": False,
+                        "schema": { "type": "string" },
+                        "description": "The Quick Ref ID to search."
+                    },
+                    {
+                        "name": "county",
+                        "in": "query",
+                        "required": True,
+                        "schema": {
+                            "type": "string",
+                            "enum": ["fortbend", "harris"]
                         },
-                        {
-                            "name": "county",
-                            "in": "query",
-                            "required": True,
-                            "schema": {
-                                "type": "string",
-                                "enum": ["fortbend", "harris"]
-                            },
-                            "description": "The county to search in ('fortbend' or 'harris')."
-                        }
-                    ],
-                    "responses": {
-                        "200": {
-                            "description": "Successful response",
-                            "content": {
-                                "application/json": {
-                                    "schema": {
-                                        "type": "object",
-                                        "properties": {
-                                            "owner": { "type": "string" },
-                                            "address": { "type": "string" },
-                                            "legal_description": { "type": "string" },
-                                            "subdivision": { "type": "string" },
-                                            "block": { "type": "string" },
-                                            "lot_reserve": { "type": "string" },
-                                            "deed": { "type": "string" },
-                                            "called_acreage": { "type": "string" },
-                                            "market_value": { "type": "string" },
-                                            "quickrefid": { "type": "string" },
-                                            "parcel_id": { "type": "string" },
-                                            "parcel_size_acres": { "type": "number" },
-                                            "perimeter_ft": { "type": "number" },
-                                            "maps_link": { "type": "string" },
-                                            "kmz_download_url": { "type": "string" }
-                                        }
+                        "description": "The county to search in ('fortbend' or 'harris')."
+                    },
+                    {
+                        "name": "kmz",
+                        "in": "query",
+                        "required": False,
+                        "schema": { "type": "boolean" },
+                        "description": "Build the KMZ file with the estimate instead of on first download."
+                    },
+                    {
+                        "name": "fields",
+                        "in": "query",
+                        "required": False,
+                        "schema": { "type": "string" },
+                        "description": "Comma-separated response keys to return; omit for all of them."
+                    }
+                ],
+                "responses": {
+                    "200": {
+                        "description": "Successful response",
+                        "content": {
+                            "application/json": {
+                                "schema": {
+                                    "type": "object",
+                                    "properties": {
+                                        "owner": { "type": "string" },
+                                        "address": { "type": "string" },
+                                        "legal_description": { "type": "string" },
+                                        "subdivision": { "type": "string" },
+                                        "block": { "type": "string" },
+                                        "lot_reserve": { "type": "string" },
+                                        "deed": { "type": "string" },
+                                        "called_acreage": { "type": "string" },
+                                        "market_value": { "type": "string" },
+                                        "quickrefid": { "type": "string" },
+                                        "parcel_id": { "type": "string" },
+                                        "parcel_size_acres": { "type": "number" },
+                                        "perimeter_ft": { "type": "number" },
+                                        "maps_link": { "type": "string" },
+                                        "kmz_download_url": { "type": ["string", "null"] }
                                     }
                                 }
                             }
@@ -300,7 +597,20 @@ def openapi_spec():
                 }
             }
         }
-    })
+    }
+}
+
+# The spec is static, so serialize it and compute its ETag once.
+_OPENAPI_BYTES = orjson.dumps(OPENAPI_SPEC)
+_OPENAPI_ETAG = hashlib.md5(_OPENAPI_BYTES).hexdigest()
+
+@app.route("/openapi.json")
+def openapi_spec():
+    response = Response(_OPENAPI_BYTES, mimetype="application/json")
+    response.set_etag(_OPENAPI_ETAG)
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400
+    return response.make_conditional(request)
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 10000))